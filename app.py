@@ -3,29 +3,251 @@ import yfinance as yf
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
-from datetime import datetime
+import json
+import os
+import pickle
+import re
+import tempfile
+import time
+from datetime import datetime, time as dtime
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+try:
+    from yfinance.exceptions import YFRateLimitError
+except ImportError:
+    # 舊版 yfinance 沒有此例外，只能依 HTTP 429 狀態碼判斷限流
+    class YFRateLimitError(Exception):
+        pass
 
 # --- 頁面設定 ---
 st.set_page_config(page_title="Stock Guardian AI v3.0", page_icon="🛡️", layout="wide")
 
+# --- 數值工具 ---
+def rolling_mean(values, window):
+    """以前綴和 (cumsum 差分) 計算移動平均，O(N) 單次掃描"""
+    out = np.full(len(values), np.nan)
+    if len(values) < window:
+        return out
+    csum = np.concatenate(([0.0], np.cumsum(values)))
+    out[window - 1:] = (csum[window:] - csum[:-window]) / window
+    return out
+
+def wilder_rsi(values, period=14):
+    """Wilder 平滑法 RSI：前 period 日漲跌幅平均為起點，之後 avg = (avg*(n-1) + x) / n"""
+    out = np.full(len(values), np.nan)
+    if len(values) <= period:
+        return out
+    delta = np.diff(values)
+    gain = np.maximum(delta, 0.0)
+    loss = np.maximum(-delta, 0.0)
+    # 起點換成簡單平均後，其餘遞迴即為 alpha=1/period 的 EWM (C 實作)
+    gain[period - 1] = gain[:period].mean()
+    loss[period - 1] = loss[:period].mean()
+    avg_gain = pd.Series(gain[period - 1:]).ewm(alpha=1 / period, adjust=False).mean().to_numpy()
+    avg_loss = pd.Series(loss[period - 1:]).ewm(alpha=1 / period, adjust=False).mean().to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out[period:] = 100 - 100 / (1 + avg_gain / avg_loss)
+    return out
+
+# --- 資料快取 ---
+CACHE_DIR = Path(".cache")
+MAX_RETRIES = 3
+HISTORY_TTL = 900  # 盤中數據的有效秒數，與記憶體快取相同
+
+# 台股交易時段 (週一至週五 09:00-13:30)，收盤後保留緩衝讓最終收盤價入庫
+TW_TZ = ZoneInfo("Asia/Taipei")
+SESSION_OPEN = dtime(9, 0)
+SESSION_SETTLED = dtime(14, 0)
+
+def download_history(ticker_symbol, period):
+    """向 yfinance 下載歷史數據；只有被限流 (HTTP 429) 才以指數退避重試"""
+    for attempt in range(MAX_RETRIES):
+        try:
+            return yf.Ticker(ticker_symbol).history(period=period, actions=False)
+        except Exception as e:
+            # 以例外型別 / HTTP 狀態碼判斷，避免代號或網址中的 "429" 被誤判
+            response = getattr(e, 'response', None)
+            rate_limited = (isinstance(e, YFRateLimitError)
+                            or getattr(response, 'status_code', None) == 429)
+            if not rate_limited or attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+# 已確認的 上市(.TW)/上櫃(.TWO) 後綴，跨次執行保存，避免每次都重新試探
+SUFFIX_MAP_PATH = CACHE_DIR / "suffix.json"
+
+def load_suffix_map():
+    """讀取股票代號 -> 市場後綴對照表"""
+    try:
+        return json.loads(SUFFIX_MAP_PATH.read_text())
+    except (OSError, ValueError):
+        return {}
+
+SUFFIX_MAP = load_suffix_map()
+
+def write_suffix_map():
+    """寫回對照表；寫入失敗不影響分析"""
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        SUFFIX_MAP_PATH.write_text(json.dumps(SUFFIX_MAP))
+    except OSError:
+        pass
+
+def save_suffix(stock_id, suffix):
+    """記錄已確認的市場後綴"""
+    SUFFIX_MAP[stock_id] = suffix
+    write_suffix_map()
+
+def forget_suffix(stock_id):
+    """移除可能已失效的市場後綴 (例如上櫃轉上市)，下次分析會重新試探"""
+    if SUFFIX_MAP.pop(stock_id, None) is not None:
+        write_suffix_map()
+
+# 最新 K 棒超過此天數 (日曆日，涵蓋週末與春節等長假) 視為該代號已停止交易
+STALE_DAYS = 10
+
+def is_history_stale(df):
+    """最新一根 K 棒是否已久未更新"""
+    return (datetime.now(TW_TZ).date() - df.index[-1].date()).days > STALE_DAYS
+
+def clean_history(df):
+    """只保留分析用到的收盤價，並以單次 numpy 遮罩濾掉缺值與 0 元的異常 K 棒 (NaN > 0 為 False)"""
+    if df.empty:
+        return df
+    return df.loc[df['Close'].to_numpy() > 0, ['Close']]
+
+# 只有符合此格式的代號才會落地成快取檔名，避免使用者輸入跳出 .cache/ 或被當成 glob 樣式
+CACHEABLE_SYMBOL = re.compile(r'[A-Za-z0-9.^=-]+')
+
+def history_cache_path(ticker_symbol, period):
+    """當日 (台北時間) 的磁碟快取路徑；代號含其他字元時回傳 None，不使用磁碟快取"""
+    if not CACHEABLE_SYMBOL.fullmatch(ticker_symbol):
+        return None
+    return CACHE_DIR / f"{ticker_symbol}_{period}_{datetime.now(TW_TZ):%Y%m%d}.pkl"
+
+def is_cache_fresh(path, ticker_symbol):
+    """快取在 HISTORY_TTL 內有效；台股 (.TW/.TWO) 若抓取後不可能再有盤中成交 (週末、抓取晚於收盤、尚未開盤) 則沿用"""
+    now = datetime.now(TW_TZ)
+    fetched_at = datetime.fromtimestamp(path.stat().st_mtime, TW_TZ)
+    if (now - fetched_at).total_seconds() < HISTORY_TTL:
+        return True
+    if not ticker_symbol.upper().endswith(('.TW', '.TWO')):
+        return False  # 其他市場的交易時段不同，一律只用 TTL
+    traded_since = (now.weekday() < 5
+                    and fetched_at.time() < SESSION_SETTLED
+                    and now.time() >= SESSION_OPEN)
+    return not traded_since
+
+def read_history_cache(path, ticker_symbol):
+    """讀取磁碟快取；檔案不存在或已過期回傳 None，損毀的檔案會刪除後回傳 None"""
+    if path is None:
+        return None
+    try:
+        if not is_cache_fresh(path, ticker_symbol):
+            return None
+        return pd.read_pickle(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        try:
+            path.unlink(missing_ok=True)
+        except OSError:
+            pass
+        return None
+
+def write_history_cache(ticker_symbol, period, df):
+    """寫入當日磁碟快取；寫入失敗不影響分析"""
+    path = history_cache_path(ticker_symbol, period)
+    if path is None:
+        return
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        for old in CACHE_DIR.glob(f"{ticker_symbol}_{period}_*.pkl"):
+            if old != path:
+                old.unlink(missing_ok=True)  # 清掉前一天的舊檔 (可能已被其他 session 刪除)
+        # 先寫暫存檔再原子替換，讀取端不會讀到寫到一半的檔案
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        os.close(fd)
+        try:
+            df.to_pickle(tmp)
+            os.replace(tmp, path)
+        finally:
+            Path(tmp).unlink(missing_ok=True)
+    except OSError:
+        pass
+
+@st.cache_data(ttl=HISTORY_TTL, show_spinner=False)
+def load_history(ticker_symbol, period="1y"):
+    """抓取歷史數據；記憶體快取 15 分鐘，台股磁碟快取在收盤後或未開盤時可跨重啟沿用"""
+    df = read_history_cache(history_cache_path(ticker_symbol, period), ticker_symbol)
+    if df is not None:
+        return df
+
+    df = clean_history(download_history(ticker_symbol, period))
+    if not df.empty:
+        write_history_cache(ticker_symbol, period, df)
+    return df
+
+def probe_market(stock_id, period="1y"):
+    """一次批次下載 .TW 與 .TWO，回傳有資料的代號 (皆無則 None)，並把該段數據寫入磁碟快取"""
+    symbols = [f"{stock_id}.TW", f"{stock_id}.TWO"]
+    raw = yf.download(symbols, period=period, group_by='ticker', auto_adjust=True,
+                      progress=False, threads=True)
+    for symbol in symbols:
+        if symbol not in raw.columns.get_level_values(0):
+            continue
+        df = clean_history(raw[symbol])
+        if not df.empty:
+            write_history_cache(symbol, period, df)
+            return symbol
+
+    # yf.download 會吞掉個別代號的錯誤 (限流、斷線)；兩邊皆空時改逐一走 download_history，
+    # 讓真正的錯誤經退避重試後拋出，而不是被當成查無此股
+    for symbol in symbols:
+        df = clean_history(download_history(symbol, period))
+        if not df.empty:
+            write_history_cache(symbol, period, df)
+            return symbol
+    return None
+
 # --- 核心分析類別 (修改為適配 Streamlit) ---
 class StockAnalystAI:
+    __slots__ = ('stock_id', 'ticker_symbol')
+
     def __init__(self, ticker):
-        self.ticker_symbol = f"{ticker}.TW" if not ticker.endswith('.TW') and not ticker.isdigit() == False else f"{ticker}.TW"
-        # 簡單處理輸入，若輸入 2408 自動變 2408.TW
+        self.stock_id = ticker
+        # 簡單處理輸入，若輸入 2408 自動變 2408.TW (已知上櫃股則用 .TWO)
         if ticker.isdigit():
-             self.ticker_symbol = f"{ticker}.TW"
+             self.ticker_symbol = f"{ticker}{SUFFIX_MAP.get(ticker, '.TW')}"
         else:
              self.ticker_symbol = ticker
 
     def fetch_data(self):
         """抓取歷史數據"""
         try:
-            stock = yf.Ticker(self.ticker_symbol)
-            df = stock.history(period="1y")
+            df = None
+            if self.stock_id.isdigit() and self.stock_id in SUFFIX_MAP:
+                df = load_history(self.ticker_symbol)
+                if df.empty or is_history_stale(df):
+                    # 記錄的市場查無新數據 (可能已轉板)，清掉後重新試探
+                    forget_suffix(self.stock_id)
+                    df = None
+            if self.stock_id.isdigit() and self.stock_id not in SUFFIX_MAP:
+                # 未知市場：上市/上櫃合併成一次請求試探，數據同時寫入快取
+                symbol = probe_market(self.stock_id)
+                if symbol is None:
+                    st.error(f"❌ 找不到股票代號: {self.stock_id}，請確認輸入正確。")
+                    return None
+                self.ticker_symbol = symbol
+                save_suffix(self.stock_id, symbol[len(self.stock_id):])
+            if df is None:
+                df = load_history(self.ticker_symbol)
             if df.empty:
-                st.error(f"❌ 找不到股票代號: {self.ticker_symbol}，請確認輸入正確。")
+                st.error(f"❌ 找不到股票代號: {self.stock_id}，請確認輸入正確。")
                 return None
+            if is_history_stale(df):
+                st.warning(f"⚠️ {self.ticker_symbol} 最新數據停在 {df.index[-1]:%Y-%m-%d}，可能已暫停交易或轉板。")
             return df
         except Exception as e:
             st.error(f"連線錯誤: {e}")
@@ -33,28 +255,25 @@ class StockAnalystAI:
 
     def calculate_technicals(self, df):
         """計算技術指標"""
-        df['MA20'] = df['Close'].rolling(window=20).mean()
-        df['MA60'] = df['Close'].rolling(window=60).mean()
+        close = df['Close'].to_numpy(dtype=np.float64, copy=False)
+        ma60 = rolling_mean(close, 60)
+        df['MA60'] = ma60
         
-        # 乖離率計算
-        df['Bias_60'] = (df['Close'] - df['MA60']) / df['MA60'] * 100
+        # 乖離率計算 (直接在 numpy 陣列上運算，不產生中間 Series)
+        df['Bias_60'] = (close - ma60) / ma60 * 100
         
-        # RSI 計算
-        delta = df['Close'].diff()
-        gain = (delta.where(delta > 0, 0)).rolling(window=14).mean()
-        loss = (-delta.where(delta < 0, 0)).rolling(window=14).mean()
-        rs = gain / loss
-        df['RSI'] = 100 - (100 / (1 + rs))
+        # RSI 計算 (Wilder 平滑)
+        df['RSI'] = wilder_rsi(close, 14)
         
         return df
 
     def run_analysis(self, df, eps_status, gm_status, chips_vol):
         """執行評分邏輯"""
-        data = df.iloc[-1] # 最新一筆
-        price = data['Close']
-        ma60 = data['MA60']
-        bias_60 = data['Bias_60']
-        rsi = data['RSI']
+        cols = ['Close', 'MA60', 'Bias_60', 'RSI']
+        values = df[cols].to_numpy() # 一次轉成 numpy，避免逐欄 .iloc 查找
+        latest = values[-1].tolist() # 轉成 Python float，評分運算不經 numpy 純量
+        price, ma60, bias_60, rsi = latest
+        data = dict(zip(cols, latest)) # 最新一筆
         
         score = 0
         report_logs = []
@@ -119,7 +338,7 @@ class StockAnalystAI:
             report_logs.append(f"🔻 [籌碼面] 法人賣超 ({formatted_vol} 張)")
             
         # 壓低吃貨偵測
-        prev_close = df.iloc[-2]['Close']
+        prev_close = float(values[-2, 0])
         if price < prev_close and chips_vol > 0:
              report_logs.append("✨ [籌碼面] 偵測到「壓低吃貨」行為 (價跌量增+法人買)")
              chip_score += 0.5 # 加分
@@ -128,6 +347,19 @@ class StockAnalystAI:
         
         return score, report_logs, data
 
+# --- 圖表 ---
+@st.cache_resource(max_entries=32, show_spinner=False)
+def build_trend_fig(ticker, last_ts, last_close, _df):
+    """繪製股價 vs 季線圖；同一檔股票、同一根最新 K 棒與收盤價只建一次 (_df 不參與雜湊)"""
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=_df.index, y=_df['Close'], 
+                             mode='lines', name='收盤價'))
+    fig.add_trace(go.Scatter(x=_df.index, y=_df['MA60'], 
+                             mode='lines', name='季線 (60MA)', line=dict(color='orange')))
+    
+    fig.update_layout(title=f"{ticker} 股價 vs 季線", xaxis_title="日期", yaxis_title="價格")
+    return fig
+
 # --- UI 介面 ---
 st.title("🛡️ Stock Guardian AI v3.0 (Analyst Edition)")
 st.markdown("### 全方位即時股票分析系統 (yfinance + 手動校正)")
@@ -194,20 +426,14 @@ if run_btn:
 
         # 3. 詳細分析日誌
         with st.expander("查看詳細分析邏輯 (Logic Logs)", expanded=True):
-            for log in logs:
-                st.write(log)
+            st.markdown("\n\n".join(logs)) # 一次送出，避免逐行建立元件
 
         # 4. 互動圖表 (證明 MA60 是對的)
         st.divider()
         st.subheader("📈 趨勢驗證圖表")
         
-        fig = go.Figure()
-        fig.add_trace(go.Scatter(x=df_processed.index, y=df_processed['Close'], 
-                                 mode='lines', name='收盤價'))
-        fig.add_trace(go.Scatter(x=df_processed.index, y=df_processed['MA60'], 
-                                 mode='lines', name='季線 (60MA)', line=dict(color='orange')))
-        
-        fig.update_layout(title=f"{ticker_input} 股價 vs 季線", xaxis_title="日期", yaxis_title="價格")
+        fig = build_trend_fig(ticker_input, df_processed.index[-1],
+                              float(df_processed['Close'].iat[-1]), df_processed)
         st.plotly_chart(fig, use_container_width=True)
 
     else: